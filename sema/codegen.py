@@ -1,3 +1,5 @@
+import z3
+import z3_utils
 import gen_rules
 import description as desc
 from typing import List
@@ -7,6 +9,10 @@ from tqdm import tqdm
 import ir
 
 def preprocess(y):
+  # let z3 shrink the formula before we start eliminating branches ourselves
+  y = z3.simplify(y,
+      bv_ite2id=True, bv_le_extra=True, hoist_ite=True,
+      elim_ite=False, hi_div0=True, local_ctx=True)
   return reduce_bitwidth(elim_redundant_branches(elim_dead_branches(y)))
 
 def emit_instruction_bindings(insts : List[desc.Instruction], binding_vector_name, outf):
@@ -14,6 +20,7 @@ def emit_instruction_bindings(insts : List[desc.Instruction], binding_vector_nam
 
   pbar = tqdm(insts)
   for inst in pbar:
+    z3_utils.clear_z3_app_cache()
     translator = Translator()
     pbar.set_description('processing '+inst.name)
     try:
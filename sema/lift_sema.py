@@ -7,6 +7,8 @@ import z3_utils
 import z3
 import bisect
 import functools
+import types
+import itertools
 import operator
 import math
 import fp_sema
@@ -17,6 +19,16 @@ def trunc(x, size):
 
 bitwidth_table = [1, 8, 16, 32, 64]
 
+# i1 version of true
+bv_true = z3.BitVecVal(1, 1)
+
+# mapping (value, bitwidth) -> constant, for the common constants
+small_constants = {
+    (value, bitwidth): Constant(value=value, bitwidth=bitwidth)
+    for value in (0, 1)
+    for bitwidth in bitwidth_table
+    }
+
 reduction_ops = {
     'Add': operator.add,
     'Mul': operator.mul,
@@ -33,9 +45,19 @@ def get_size(x):
     return x.size()
 
 def round_bitwidth(bw):
-  idx = bisect.bisect_left(bitwidth_table, bw)
-  assert idx < len(bitwidth_table), "bitwidth too large for scalar operation"
-  return bitwidth_table[idx]
+  '''
+  round bw up to the closest bitwidth in `bitwidth_table`
+  '''
+  if bw <= 1:
+    return 1
+  if bw <= 8:
+    return 8
+  if bw <= 16:
+    return 16
+  if bw <= 32:
+    return 32
+  assert bw <= 64, "bitwidth too large for scalar operation"
+  return 64
 
 def trunc_zero(x):
   '''
@@ -79,56 +101,115 @@ def assert_pred(pred):
   if not pred:
     raise MatchFailure
 
+def update_args(f, new_args):
+  '''
+  rebuild f with new_args (unless none of them changed)
+  '''
+  args = f.children()
+  if all(a.eq(b) for a, b in zip(args, new_args)):
+    return f
+  return z3.simplify(z3.substitute(f, *zip(args, new_args)))
+
+def visit_iteratively(visit, f):
+  '''
+  compute `visit(f)` without recursing on python's call stack.
+
+  `visit` is a generator function that, instead of calling itself
+  on a sub-formula g, does `(yield g)` to get the result of visiting g.
+  results are memoized by ast id.
+  '''
+  # mapping <ast id> -> (g, visited g);
+  # g is kept alive so that z3 doesn't recycle its id
+  visited = {}
+  # stack of formulas being visited
+  stack = [(f, visit(f))]
+  result = None
+  while stack:
+    g, visiting = stack[-1]
+    try:
+      sub = visiting.send(result)
+    except StopIteration as done:
+      stack.pop()
+      visited[g.get_id()] = g, done.value
+      result = done.value
+      continue
+    key = sub.get_id()
+    if key in visited:
+      result = visited[key][1]
+    else:
+      stack.append((sub, visit(sub)))
+      result = None
+  return result
+
 def elim_dead_branches(f):
   '''
   remove provably dead branches in z3.If
   '''
   s = z3.Solver()
+  s.set('smt.bv.size_reduce', True)
+
+  # conditions assumed on the current path
+  path = []
+  # mapping <path, cond> -> whether cond is satisfiable on that path
+  sat_cache = {}
+  def is_sat(cond):
+    key = tuple(path), z3_utils.askey(cond)
+    if key not in sat_cache:
+      sat_cache[key] = s.check(cond) != z3.unsat
+    return sat_cache[key]
+
+  def classify(cond):
+    '''
+    return True (False) if cond always (never) holds on the current path,
+    and None if it can go either way
+    '''
+    simplified = z3.simplify(cond)
+    if z3.is_true(simplified):
+      return True
+    if z3.is_false(simplified):
+      return False
+    if not is_sat(simplified):
+      return False
+    if not is_sat(z3.Not(simplified)):
+      return True
+    return None
 
-  cache = {}
-  def memoize(elim):
-    def wrapped(f):
-      key = z3_utils.askey(f)
-      if key in cache:
-        return cache[key]
-      new_f = elim(f)
-      cache[key] = new_f
-      return new_f
-    return wrapped
-
-  @memoize
   def elim(f):
     if z3.is_app_of(f, z3.Z3_OP_ITE):
       cond, a, b = f.children()
-      always_true = s.check(z3.Not(cond)) == z3.unsat
-      if always_true:
-        return elim(a)
-      always_false = s.check(cond) == z3.unsat
-      if always_false:
-        return elim(b)
+      taken = classify(cond)
+      if taken is True:
+        return (yield a)
+      if taken is False:
+        return (yield b)
 
-      cond2 = elim(cond)
+      cond2 = yield cond
 
       # can't statically determine which branch, follow both!
       # 1) follow the true branch
       s.push()
       s.add(cond)
-      a2 = elim(a)
+      path.append(z3_utils.askey(cond))
+      a2 = yield a
+      path.pop()
       s.pop()
 
       # 2) follow the false branch
       s.push()
       s.add(z3.Not(cond))
-      b2 = elim(b)
+      path.append(z3_utils.askey(z3.Not(cond)))
+      b2 = yield b
+      path.pop()
       s.pop()
 
       return z3.simplify(z3.If(cond2, a2, b2))
     else:
-      args = f.children()
-      new_args = [elim(arg) for arg in args]
-      return z3.simplify(z3.substitute(f, *zip(args, new_args)))
+      new_args = []
+      for arg in f.children():
+        new_args.append((yield arg))
+      return update_args(f, new_args)
 
-  return elim(f)
+  return visit_iteratively(elim, f)
 
 def elim_redundant_branches(f):
   '''
@@ -136,21 +217,12 @@ def elim_redundant_branches(f):
   '''
   s = z3.Solver()
 
-  cache = {}
-  def memoize(elim):
-    def wrapped(f):
-      key = z3_utils.askey(f)
-      if key in cache:
-        return cache[key]
-      new_f = elim(f)
-      cache[key] = new_f
-      return new_f
-    return wrapped
-
-  @memoize
   def elim(f):
     if z3.is_app_of(f, z3.Z3_OP_ITE):
-      cond, a, b = [elim(x) for x in f.children()]
+      cond, a, b = f.children()
+      cond = yield cond
+      a = yield a
+      b = yield b
 
       # guess we can put a in both side
       s.push()
@@ -173,11 +245,12 @@ def elim_redundant_branches(f):
       # a and b are different...
       return z3.simplify(z3.If(cond, a, b))
     else:
-      args = f.children()
-      new_args = [elim(arg) for arg in args]
-      return z3.simplify(z3.substitute(f, *zip(args, new_args)))
+      new_args = []
+      for arg in f.children():
+        new_args.append((yield arg))
+      return update_args(f, new_args)
 
-  return elim(f)
+  return visit_iteratively(elim, f)
 
 
 def reduce_bitwidth(f):
@@ -189,31 +262,16 @@ def reduce_bitwidth(f):
   do this similarly for `f = op concat(0, a), const`, where const
   has unnecessarily large bitwidth
   '''
-  # mapping f -> bitwidth-reduced f
-  reduced = {}
-
-  def memoize(reducer):
-    def wrapped(f):
-      key = z3_utils.askey(f)
-      if key in reduced:
-        return reduced[key]
-      f_reduced = reducer(f)
-      reduced[key] = f_reduced
-      return f_reduced
-    return wrapped
-
-  @memoize
   def reduce_bitwidth_rec(f):
-    key = z3_utils.askey(f)
-    if key in reduced:
-      return reduced[key]
-
     op = z3_utils.get_z3_app(f)
     # attempt to recursively reduce the bitwidth of sub computation
-    new_args = [reduce_bitwidth_rec(arg) for arg in f.children()]
+    new_args = []
+    for arg in f.children():
+      new_args.append((yield arg))
 
-    if op not in alu_op_constructor:
-      return z3.simplify(z3.substitute(f, *zip(f.children(), new_args)))
+    alu_op = alu_op_constructor.get(op)
+    if alu_op is None:
+      return update_args(f, new_args)
 
     is_unsigned = True
     pre_zext_args = [trunc_zero(x) for x in new_args]
@@ -232,7 +290,7 @@ def reduce_bitwidth(f):
     else:
       # FIXME: also handle signed operation
       # give up
-      return z3.simplify(f.decl()(*new_args))
+      return update_args(f, new_args)
 
     if is_unsigned:
       required_bits = max(required_bits, max(x.size() for x in pre_zext_args))
@@ -240,12 +298,12 @@ def reduce_bitwidth(f):
           z3.ZeroExt(required_bits-x.size(), x)
           for x in pre_zext_args
           ]
-      f_reduced = alu_op_constructor[op](*zext_args)
+      f_reduced = alu_op(*zext_args)
       if f_reduced.size() > f.size(): # give up
-        return z3.simplify(alu_op_constructor[op](*new_args))
+        return z3.simplify(alu_op(*new_args))
       return z3.simplify(z3.ZeroExt(f.size()-f_reduced.size(), f_reduced))
 
-  return reduce_bitwidth_rec(f)
+  return visit_iteratively(reduce_bitwidth_rec, f)
 
 def typecheck(dag):
   '''
@@ -342,6 +400,9 @@ op_table = {
     z3.Z3_OP_BSMOD_I: 'SRem',
     }
 
+# `op_table` as a list indexed by z3 op kinds (None if unsupported)
+op_list = [op_table.get(z3op) for z3op in range(max(op_table) + 1)]
+
 # translation table from uninterp. func to our ir (basically LLVM)
 float_ops = {
     'neg': 'FNeg',
@@ -365,16 +426,17 @@ def is_simple_extraction(ext):
       z3.is_app_of(x, z3.Z3_OP_UNINTERPRETED) and
       len(x.children()) == 0)
 
-def partition_slices(slices):
-  partition = set()
-  for s in slices:
-    for s2 in partition:
-      if s.overlaps(s2):
-        partition.remove(s2)
-        partition.add(s.union(s2))
-        break
+def partition_bit_ranges(los, his):
+  '''
+  merge the overlapping bit ranges [los[i], his[i]),
+  return the merged ranges sorted by their lower bounds
+  '''
+  partition = []
+  for lo, hi in sorted(zip(los, his)):
+    if partition and lo < partition[-1][1]:
+      partition[-1][1] = max(partition[-1][1], hi)
     else:
-      partition.add(s)
+      partition.append([lo, hi])
   return partition
 
 class ExtractionHistory:
@@ -383,48 +445,56 @@ class ExtractionHistory:
   done on a set of live-in bitvector,
   '''
   def __init__(self):
-    # list of extracted slices
-    self.extracted_slices = defaultdict(list)
+    # mapping <live-in> -> (<lower bounds>, <upper bounds>) of the extracted slices
+    self.extracted_slices = defaultdict(lambda: ([], []))
+    # mapping (<live-in id>, lo, hi) -> slice, so that each slice is recorded once
+    self.recorded = {}
     self.id_counter = 0
 
   def record(self, ext):
     assert is_simple_extraction(ext)
     [x] = ext.children()
     hi, lo = ext.params()
-    s = Slice(x, lo, hi+1)
-    self.extracted_slices[x].append(s)
-    return s
+    key = x.get_id(), lo, hi+1
+    if key not in self.recorded:
+      los, his = self.extracted_slices[x]
+      los.append(lo)
+      his.append(hi+1)
+      self.recorded[key] = Slice(x, lo, hi+1)
+    return self.recorded[key]
 
   def translate_slices(self, translator):
     '''
     return a map <slice> -> <ir>
     '''
     translated = {}
-    for slices in self.extracted_slices.values():
-      partition = partition_slices(slices)
-      for s in slices:
-        for root_slice in partition:
-          if s.overlaps(root_slice):
-            lo = s.lo - root_slice.lo
-            hi = s.hi - root_slice.lo
-            assert root_slice.size() >= s.size()
-            if s == root_slice:
-              translated[s] = root_slice
-            elif lo == 0:
-              # truncation
-              translated[s] = trunc(
-                  translator.translate(root_slice.to_z3()),
-                  round_bitwidth(s.size()))
-            else: # lo > 0
-              # shift right + truncation
-              #shift = Instruction(
-              #    op='LShr',
-              #    bitwidth=root_slice.size(),
-              #    args=[root_slice])
-              #translated[s] = trunc(shift, s.size())
-              shift = translator.translate(z3.LShR(root_slice.to_z3(), lo))
-              translated[s] = trunc(shift, round_bitwidth(s.size()))
-            break
+    for x, (los, his) in self.extracted_slices.items():
+      partition = partition_bit_ranges(los, his)
+      partition_los = [root_lo for root_lo, _ in partition]
+      root_slices = [Slice(x, root_lo, root_hi) for root_lo, root_hi in partition]
+      for s_lo, s_hi in zip(los, his):
+        s = self.recorded[x.get_id(), s_lo, s_hi]
+        # find the (only) root slice containing s
+        root_slice = root_slices[bisect.bisect_right(partition_los, s.lo) - 1]
+        lo = s.lo - root_slice.lo
+        hi = s.hi - root_slice.lo
+        assert root_slice.size() >= s.size()
+        if s == root_slice:
+          translated[s] = root_slice
+        elif lo == 0:
+          # truncation
+          translated[s] = trunc(
+              translator.translate(root_slice.to_z3()),
+              round_bitwidth(s.size()))
+        else: # lo > 0
+          # shift right + truncation
+          #shift = Instruction(
+          #    op='LShr',
+          #    bitwidth=root_slice.size(),
+          #    args=[root_slice])
+          #translated[s] = trunc(shift, s.size())
+          shift = translator.translate(z3.LShR(root_slice.to_z3(), lo))
+          translated[s] = trunc(shift, round_bitwidth(s.size()))
     return translated
 
 def recover_sub(f):
@@ -466,7 +536,7 @@ class Translator:
         z3.Z3_OP_UNINTERPRETED: self.translate_uninterpreted,
         z3.Z3_OP_BNUM: self.translate_constant,
         }
-    # mapping <formula> -> <ir node id>
+    # mapping <ast id> -> (<formula>, <ir node id>)
     self.translated = {}
     # translated IR
     self.ir = {}
@@ -478,7 +548,12 @@ class Translator:
     return new_id
 
   def translate_constant(self, c):
-    return Constant(value=c.as_long(), bitwidth=round_bitwidth(c.size()))
+    value = c.as_long()
+    bitwidth = round_bitwidth(c.size())
+    small_constant = small_constants.get((value, bitwidth))
+    if small_constant is not None:
+      return small_constant
+    return Constant(value=value, bitwidth=bitwidth)
 
   def translate_formula(self, f, elem_size):
     '''
@@ -488,30 +563,23 @@ class Translator:
       outs = [self.translate(f)]
     else:
       assert(f.size() % elem_size == 0)
-      num_elems = f.size() // elem_size
+      # children ordered from the lowest bits to the highest
+      children = f.children()[::-1]
+      # x_offsets[i] is the offset of the first bit of children[i]
+      x_offsets = [0, *itertools.accumulate(x.size() for x in children)]
       elems = []
-      partial_elem = []
-      partial_size = 0
-      offset = 0
-      x_offset = 0
-      for x in reversed(f.children()):
-        while offset < x_offset + x.size():
-          begin = offset - x_offset
-          end = min(begin + elem_size - partial_size, x.size())
-          chunk_size = end - begin
-          partial_size += chunk_size
-          offset += chunk_size
-          partial_elem.append(z3.Extract(end-1, begin, x))
-
-          if partial_size == elem_size:
-            if len(partial_elem) == 1:
-              elems.append(z3.simplify(partial_elem[0]))
-            else:
-              elems.append(z3.simplify(z3_utils.concat(partial_elem[::-1])))
-            partial_elem = []
-            partial_size = 0
-
-        x_offset += x.size()
+      for lo in range(0, f.size(), elem_size):
+        hi = lo + elem_size
+        # slice out the children covering [lo, hi)
+        i = bisect.bisect_right(x_offsets, lo) - 1
+        chunks = []
+        while x_offsets[i] < hi:
+          x_offset = x_offsets[i]
+          begin = max(lo, x_offset) - x_offset
+          end = min(hi, x_offsets[i+1]) - x_offset
+          chunks.append(z3.Extract(end-1, begin, children[i]))
+          i += 1
+        elems.append(z3.simplify(z3_utils.concat(chunks[::-1])))
 
       elems.reverse()
       assert z3.Solver().check(z3_utils.concat(elems) != f) == z3.unsat
@@ -528,6 +596,35 @@ class Translator:
     return outs, self.ir
 
   def translate(self, f):
+    '''
+    translate f and return its node id.
+
+    translation is driven with an explicit stack (instead of recursion)
+    so that deep formulas don't blow python's stack:
+    translators that need their operands translated first are generators
+    that do `(yield g)` to get the node id of g
+    '''
+    # stack of formulas being translated,
+    # each of which is (<formula>, <node id>, <translator>)
+    stack = []
+    node_id = self.begin_translation(f, stack)
+    while stack:
+      f, f_id, translating = stack[-1]
+      try:
+        g = translating.send(node_id)
+      except StopIteration as done:
+        stack.pop()
+        node_id = self.finish_translation(f, f_id, done.value)
+        continue
+      node_id = self.begin_translation(g, stack)
+    return node_id
+
+  def begin_translation(self, f, stack):
+    '''
+    return the node id of f if it can be translated right away,
+    otherwise push f (whose operands need to be translated first)
+    to `stack` and return None
+    '''
     # detect `~(a | b)` and turn them into `~a & ~b`
     try:
       [x] = match_with(f, z3.Z3_OP_BNOT, 1)
@@ -537,35 +634,50 @@ class Translator:
     except MatchFailure:
       pass
 
-    if f in self.translated:
-      return self.translated[f]
+    key = f.get_id()
+    if key in self.translated:
+      return self.translated[key][1]
     f = recover_sub(f)
     node_id = self.new_id()
     z3op = z3_utils.get_z3_app(f)
 
-    if z3op in self.z3op_translators:
-      # see if there's a specialized translator
-      node = self.z3op_translators[z3op](f)
+    # see if there's a specialized translator
+    z3op_translator = self.z3op_translators.get(z3op)
+    if z3op_translator is not None:
+      translating = z3op_translator(f)
     else:
-      op = op_table[z3op]
-      assert z3.is_bv(f) or z3.is_bool(f)
-      # expand flattened reduction operator
-      if op in reduction_ops:
-        f = functools.reduce(reduction_ops[op], f.children())
-      bitwidth = f.size() if z3.is_bv(f) else 1
-      node = Instruction(
-          op=op, bitwidth=round_bitwidth(bitwidth),
-          args=[self.translate(arg) for arg in f.children()])
-
-    self.translated[f] = node_id
+      translating = self.translate_generic(f, z3op)
+
+    if not isinstance(translating, types.GeneratorType):
+      return self.finish_translation(f, node_id, translating)
+    stack.append((f, node_id, translating))
+    return None
+
+  def translate_generic(self, f, z3op):
+    op = op_list[z3op] if z3op < len(op_list) else None
+    assert op is not None, "unsupported z3 operator"
+    assert z3.is_bv(f) or z3.is_bool(f)
+    # expand flattened reduction operator (into a balanced tree,
+    # our IR only has binary operators)
+    reduction_op = reduction_ops.get(op)
+    if reduction_op is not None:
+      f = z3_utils.balanced_reduce(reduction_op, f.children())
+    bitwidth = f.size() if z3.is_bv(f) else 1
+    args = []
+    for arg in f.children():
+      args.append((yield arg))
+    return Instruction(op=op, bitwidth=round_bitwidth(bitwidth), args=args)
+
+  def finish_translation(self, f, node_id, node):
+    self.translated[f.get_id()] = f, node_id
     self.ir[node_id] = node
     return node_id
 
   def translate_true(*_):
-    return Constant(z3.BitVecVal(1, 1))
+    return small_constants[1, 1]
 
   def translate_false(*_):
-    return Constant(z3.BitVecVal(0, 1))
+    return small_constants[0, 1]
 
   def translate_bool_not(self, f):
     [x] = f.children()
@@ -573,19 +685,19 @@ class Translator:
         op='Xor',
         bitwidth=1,
         args=[
-          self.translate(z3.BitVecVal(1,1)),
-          self.translate(x)])
+          (yield bv_true),
+          (yield x)])
 
   def translate_not(self, f):
     [x] = f.children()
     # not x == xor -1, x
-    node_id = self.translate((-1) ^ x)
+    node_id = yield (-1) ^ x
     return self.ir[node_id]
 
   def translate_neg(self, f):
     [x] = f.children()
     # not x == sub 0, x
-    node_id = self.translate(0-x)
+    node_id = yield 0-x
     return self.ir[node_id]
 
   def translate_extract(self, ext):
@@ -599,9 +711,9 @@ class Translator:
 
     _, lo = ext.params()
     if lo > 0:
-      translated = self.translate(z3.LShR(x, lo))
+      translated = yield z3.LShR(x, lo)
     else:
-      translated = self.translate(x)
+      translated = yield x
     translated_size = get_size(self.ir[translated])
     bw = round_bitwidth(ext.size())
     assert translated_size >= bw
@@ -612,23 +724,38 @@ class Translator:
   def try_translate_sext(self, concat):
     '''
     don't even bother trying to pattern match this...
-    just prove it
+    just prove it (unless it's obviously not a sign extension)
     '''
-    x = concat.children()[-1]
+    *hi_bits, x = concat.children()
+    if all(z3.is_bv_value(bits) for bits in hi_bits):
+      # constant high bits can only replicate the sign bit if they are
+      # all ones (or all zeros, in which case we treat it as zext)
+      hi_bits_val = z3.simplify(z3_utils.concat(hi_bits)).as_long()
+      if hi_bits_val != z3_utils.get_unsigned_max(concat.size()-x.size()):
+        return None
     sext = z3.SignExt(concat.size()-x.size(), x)
-    is_sext = self.solver.check(concat != sext) == z3.unsat
+    differs = z3.simplify(concat != sext)
+    if z3.is_false(differs):
+      is_sext = True
+    elif z3.is_true(differs):
+      is_sext = False
+    else:
+      self.solver.push()
+      self.solver.add(differs)
+      is_sext = self.solver.check() == z3.unsat
+      self.solver.pop()
     if is_sext:
       return Instruction(
           op='SExt',
           bitwidth=round_bitwidth(concat.size()),
-          args=[self.translate(x)])
+          args=[(yield x)])
     return None
 
   def translate_concat(self, concat):
     '''
     try to convert concat of sign bit to sext
     '''
-    sext = self.try_translate_sext(concat)
+    sext = yield from self.try_translate_sext(concat)
     if sext is not None:
       return sext
 
@@ -638,7 +765,7 @@ class Translator:
     assert z3.is_bv_value(a) and a.as_long() == 0,\
         "only support using concat for zero extension"
 
-    b_translated = self.translate(b)
+    b_translated = yield b
     # there's a chance that we already upgraded the bitwidth of b
     # during translation (e.g. b.size = 17 and we normalize to 32)
     concat_size = round_bitwidth(concat.size())
@@ -661,7 +788,7 @@ class Translator:
     out_bw = int(out_name[1:])
 
     saturated = z3_utils.saturate(x, in_bw, in_signed, out_bw, out_signed)
-    node_id = self.translate(z3.Extract(f.size()-1, 0, saturated))
+    node_id = yield z3.Extract(f.size()-1, 0, saturated)
     return self.ir[node_id]
 
   def translate_abs(self, f):
@@ -679,7 +806,7 @@ class Translator:
       fneg, _ = fp_sema.binary_float_op('neg', use_uninterpreted=True)
       y = z3.If(flt(x, fp_sema.fp_literal(0.0, bitwidth)), fneg(x), x)
 
-    node_id = self.translate(y)
+    node_id = yield y
     return self.ir[node_id]
 
   def translate_uninterpreted(self, f):
@@ -691,10 +818,10 @@ class Translator:
     func = f.decl().name()
 
     if func.startswith('Saturate'):
-      return self.translate_saturation(f)
+      return (yield from self.translate_saturation(f))
 
     if func.startswith('Abs'):
-      return self.translate_abs(f)
+      return (yield from self.translate_abs(f))
 
     assert func.startswith('fp_')
     _, op, _ = func.split('_')
@@ -707,6 +834,7 @@ class Translator:
 
     assert z3.is_bool(f) or f.size() in [32, 64]
     bitwidth = 1 if z3.is_bool(f) else f.size()
-    return Instruction(
-        op=float_ops[op], bitwidth=bitwidth,
-        args=[self.translate(arg) for arg in f.children()])
+    args = []
+    for arg in f.children():
+      args.append((yield arg))
+    return Instruction(op=float_ops[op], bitwidth=bitwidth, args=args)
@@ -608,8 +608,8 @@ def gen_saturation_func(bitwidth, out_signed):
 
     in_ty_str = ('s%d' if ty.is_signed else 'u%d') % val.size()
     out_ty_str = ('s%d' if out_signed else 'u%d') % bitwidth
-    in_ty_z3 = z3.BitVecSort(val.size())
-    out_ty_z3 = z3.BitVecSort(bitwidth)
+    in_ty_z3 = z3_utils.get_bv_sort(val.size())
+    out_ty_z3 = z3_utils.get_bv_sort(bitwidth)
     builtin_name = 'Saturate_%s_to_%s' % (in_ty_str, out_ty_str)
     builtin_saturate = z3_utils.get_uninterpreted_func(
         builtin_name, [in_ty_z3, out_ty_z3])
@@ -667,7 +667,7 @@ def builtin_abs(args, env):
     builtin_name = 'Abs_i%d' % bitwidth
 
   builtin = get_uninterpreted_func(builtin_name, 
-      (z3.BitVecSort(bitwidth), z3.BitVecSort(bitwidth)))
+      (z3_utils.get_bv_sort(bitwidth), z3_utils.get_bv_sort(bitwidth)))
   return builtin(val), ty
 
 def builtin_binary_func(op):
@@ -747,7 +747,7 @@ def gen_int2fp(in_signed, in_bitwidth, out_bitwidth):
 
   def uninterpreted_impl(arg):
     x, ty = arg
-    param_types = z3.BitVecSort(in_bitwidth), z3.BitVecSort(out_bitwidth)
+    param_types = z3_utils.get_bv_sort(in_bitwidth), z3_utils.get_bv_sort(out_bitwidth)
     func_name = 'conv_%s%d_to_f%d' % (
         'i' if in_signed else 'u',
         in_bitwidth,
@@ -883,7 +883,7 @@ def compile_call(call, env, pred):
     assert is_float(a_ty) and not is_literal(a_ty)
     bitwidth = a.size()
     assert bitwidth in (32, 64)
-    ty = z3.BitVecSort(bitwidth)
+    ty = z3_utils.get_bv_sort(bitwidth)
     func_name = 'fp_%s_%d' % (call.func.lower(), bitwidth)
     func = z3_utils.get_uninterpreted_func(func_name, (ty, ty))
     return func(a), a_ty
@@ -328,12 +328,15 @@ def bits_to_vec(bits, typename):
   # integer type
   return bits_to_long_vec(bits)
 
-def fuzz_intrinsic(spec, num_tests=100):
+def fuzz_intrinsic(spec, num_tests=100, sema=None):
   '''
   spec -> (spec correct, can compile)
+
+  `sema` is the result of `compile(spec)` if the caller already has it
   '''
-  param_vals, outs = compile(spec)
-  sema = param_vals, outs
+  if sema is None:
+    sema = compile(spec)
+  param_vals, outs = sema
   interpreted = []
   exe = NamedTemporaryFile(delete=False)
   exe.close()
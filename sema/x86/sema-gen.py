@@ -4,11 +4,29 @@ import sys
 from fuzzer import fuzz_intrinsic
 from compiler import compile
 from spec_serializer import dump_spec
-from multiprocessing import Pool
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from multiprocessing import Manager
+import z3
+import atexit
+import hashlib
+import re
+import shelve
+import time
 
 data_f, out_fname, num_threads = sys.argv[1:]
 num_threads = int(num_threads)
-data_root = ET.parse(data_f)
+
+def iter_intrinsics(data_f):
+  '''
+  parse the intrinsics incrementally,
+  dropping each one (unless the caller keeps it) after it's been visited
+  '''
+  context = ET.iterparse(data_f, events=('start', 'end'))
+  _, root = next(context)
+  for event, elem in context:
+    if event == 'end' and elem.tag == 'intrinsic':
+      yield elem
+      root.clear()
 
 num_parsed = 0
 num_skipped = 0
@@ -24,13 +42,104 @@ skip_to = None
 
 outf = open(out_fname, 'w')
 
-def get_verified_spec(intrin):
+# buffered output, flushed every `write_batch_size` results
+# or every `write_interval` seconds, whichever comes first
+write_batch_size = 64
+write_interval = 5
+pending_writes = []
+last_write_time = time.monotonic()
+def flush_writes():
+  global last_write_time
+  if pending_writes:
+    outf.write(''.join(pending_writes))
+    outf.flush()
+    pending_writes.clear()
+  last_write_time = time.monotonic()
+
+def close_output():
+  if not outf.closed:
+    flush_writes()
+    outf.close()
+atexit.register(close_output)
+
+# verified semantics from previous runs
+cache = shelve.open(out_fname + '.cache')
+
+# modules whose behavior determines the verified semantics
+sema_modules = [
+    'manual_parser', 'pseudocode_parser', 'lex', 'sema_ast', 'intrinsic_types',
+    'compiler', 'fp_sema', 'z3_utils', 'fuzzer', 'spec_serializer']
+
+def get_sema_version():
+  '''
+  hash the source of `sema_modules`,
+  so that changing any of them invalidates the cached semantics
+  '''
+  h = hashlib.sha1()
+  for name in sema_modules:
+    with open(sys.modules[name].__file__, 'rb') as f:
+      h.update(f.read())
+  return h.hexdigest()
+
+sema_version = get_sema_version()
+
+def get_cache_key(intrin):
+  # the trailing whitespace depends on how the file was parsed, ignore it
+  intrin.tail = None
+  digest = hashlib.sha1(ET.tostring(intrin)).hexdigest()
+  return '%s:%s:%s' % (intrin.attrib['name'], digest, sema_version)
+
+# mapping <formula key> -> (<ok>, <compiled>) for the specs fuzzed so far,
+# shared by all of the workers
+verified_formulas = None
+
+def init_worker(shared_verified_formulas):
+  global verified_formulas
+  verified_formulas = shared_verified_formulas
+
+def get_formula_key(spec, sema):
+  '''
+  hash the compiled semantics (`sema`) of `spec`,
+  modulo the names of the live-ins
+  '''
+  param_vals, outs = sema
+  renaming = [
+      (x, z3.BitVec('x%d' % i, x.size()))
+      for i, x in enumerate(param_vals)]
+  canonicalized = [z3.simplify(z3.substitute(y, *renaming)) for y in outs]
+  signature = (
+      spec.rettype, spec.inst_form,
+      [(param.type, param.is_signed) for param in spec.params])
+  h = hashlib.sha1(repr(signature).encode())
+  for y in canonicalized:
+    h.update(y.sexpr().encode())
+  return h.hexdigest()
+
+def fuzz_spec(spec):
+  '''
+  fuzz `spec` unless we've already verified an equivalent one
+  '''
+  sema = compile(spec)
+  formula_key = get_formula_key(spec, sema)
+  if formula_key in verified_formulas:
+    return verified_formulas[formula_key]
+  ok, compiled = fuzz_intrinsic(spec, num_tests=100, sema=sema)
+  if ok:
+    verified_formulas[formula_key] = ok, compiled
+  return ok, compiled
+
+def get_verified_spec(job):
+  '''
+  return (<cache key>, (<ok>, <compiled>, <intrinsic>, <cpuids>, <dumped spec>))
+  '''
+  key, intrin = job
   try:
     spec = get_spec_from_xml(intrin)
-    ok, compiled = fuzz_intrinsic(spec, num_tests=100)
-    return ok, compiled, spec
+    ok, compiled = fuzz_spec(spec)
+    spec_sema = dump_spec(spec, precision=False) if ok else None
+    return key, (ok, compiled, spec.intrin, spec.cpuids, spec_sema)
   except:
-    return False, False, spec
+    return key, (False, False, intrin.attrib['name'], None, None)
 
 debug = '_mm_sad_epu8'
 debug = None
@@ -38,8 +147,22 @@ debug = None
 from collections import defaultdict
 categories = defaultdict(int)
 
+# intrinsics we don't support, judging by their names
+blacklisted_names = {'_mm_sha1rnds4_epu32', '_rdpmc', '_rdtsc'}
+blacklisted_name_pattern = re.compile('|'.join([
+    'getcsr$', 'setcsr$',
+    '_cmp_', 'zeroall', 'zeroupper', 'mant', 'ord', '4dpwss', 'ternarylogic',
+    #'cvt',
+    '^_bit', 'lzcnt', 'popcnt']))
+
+# intrinsics we don't support, judging by their semantics
+blacklisted_sema_pattern = re.compile('|'.join(map(re.escape, [
+    'MEM', 'FP16', 'Float16', 'MOD2', 'affine_inverse_byte', 'ShiftRows',
+    'MANTISSA', 'ConvertExpFP', '<<<', ' MXCSR ', 'ZF', 'CF', 'NaN',
+    'CheckFPClass', 'ROUND', 'carry_out', 'SignBit', 'SSP'])))
+
 intrins = []
-for intrin in data_root.iter('intrinsic'):
+for intrin in iter_intrinsics(data_f):
   cpuid = intrin.find('CPUID')
   sema = intrin.find('operation') 
   inst = intrin.find('instruction')
@@ -62,22 +185,8 @@ for intrin in data_root.iter('intrinsic'):
       continue
     cpuid_text = cpuid.text
 
-  if (intrin.attrib['name'].endswith('getcsr') or
-      intrin.attrib['name'].endswith('setcsr') or
-      '_cmp_' in intrin.attrib['name'] or
-      'zeroall' in intrin.attrib['name'] or
-      'zeroupper' in intrin.attrib['name'] or
-      intrin.attrib['name'] == '_mm_sha1rnds4_epu32' or
-      'mant' in intrin.attrib['name'] or
-      'ord' in intrin.attrib['name'] or
-      '4dpwss' in intrin.attrib['name'] or
-      'ternarylogic' in intrin.attrib['name'] or
-      #'cvt' in intrin.attrib['name'] or
-      intrin.attrib['name'].startswith('_bit') or
-      intrin.attrib['name'] in ('_rdpmc', '_rdtsc') or
-      'lzcnt' in intrin.attrib['name'] or
-      'popcnt' in intrin.attrib['name']
-      ):
+  if (intrin.attrib['name'] in blacklisted_names or
+      blacklisted_name_pattern.search(intrin.attrib['name'])):
     if 'mask' in intrin.attrib['name']:
       categories['mask'] += 1
     else:
@@ -95,25 +204,7 @@ for intrin in data_root.iter('intrinsic'):
       continue
     else:
       skipped = True
-  if sema is not None and (
-      'MEM' in sema.text or
-      'FP16' in sema.text or
-      'Float16' in sema.text or
-      'MOD2' in sema.text or
-      'affine_inverse_byte' in sema.text or
-      'ShiftRows' in sema.text or
-      'MANTISSA' in sema.text or
-      'ConvertExpFP' in sema.text or
-      '<<<' in sema.text or
-      ' MXCSR ' in sema.text or
-      'ZF' in sema.text or
-      'CF' in sema.text or
-      'NaN' in sema.text or 
-      'CheckFPClass' in sema.text or
-      'ROUND' in sema.text or
-      'carry_out' in sema.text or
-      'SignBit' in sema.text or
-      'SSP' in sema.text):
+  if sema is not None and blacklisted_sema_pattern.search(sema.text):
     categories['MISC'] += 1
     continue
   if 'str' in intrin.attrib['name']:
@@ -151,27 +242,68 @@ for intrin in data_root.iter('intrinsic'):
 #pprint(categories)
 #print('Total filtered:', sum(categories.values()))
 
-pool = Pool(1 if debug else num_threads)
+cached = []
+uncached = []
+for intrin in intrins:
+  key = get_cache_key(intrin)
+  if key in cache:
+    cached.append(cache[key])
+  else:
+    uncached.append((key, intrin))
+
+# start the intrinsics with the longest semantics first
+# so that they don't end up dominating the tail
+uncached.sort(key=lambda job: len(job[1].find('operation').text), reverse=True)
+
+def run_jobs(executor, jobs, max_in_flight):
+  '''
+  run `jobs` while keeping at most `max_in_flight` of them submitted
+  '''
+  in_flight = set()
+  def wait_for_some():
+    nonlocal in_flight
+    done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+    return [future.result() for future in done]
+
+  for job in jobs:
+    if len(in_flight) >= max_in_flight:
+      yield from wait_for_some()
+    in_flight.add(executor.submit(get_verified_spec, job))
+  while in_flight:
+    yield from wait_for_some()
+
+def get_results():
+  yield from cached
+  num_workers = 1 if debug else num_threads
+  with Manager() as manager, ProcessPoolExecutor(
+      max_workers=num_workers,
+      initializer=init_worker,
+      initargs=(manager.dict(),)) as executor:
+    for key, result in run_jobs(executor, uncached, 2 * num_workers):
+      ok = result[0]
+      if ok:
+        cache[key] = result
+      yield result
+
 num_intrins = 0
-for ok, compiled, spec in pool.imap_unordered(get_verified_spec, intrins):
+for ok, compiled, intrin_name, cpuids, spec_sema in get_results():
   num_intrins+=1
   if ok:
-    spec_sema = dump_spec(spec, precision=False)
-    outf.write(spec.intrin + '\n')
-    outf.write(spec_sema + '\n')
-    outf.flush()
+    pending_writes.append(intrin_name + '\n' + spec_sema + '\n')
+    if (len(pending_writes) >= write_batch_size or
+        time.monotonic() - last_write_time >= write_interval):
+      flush_writes()
     num_interpreted += compiled
     num_ok += ok
-    print(spec.intrin, spec.cpuids, flush=True)
-    print('\tverified / parsed ',num_ok,'/', num_intrins, flush=True)
+    print(intrin_name, cpuids)
+    print('\tverified / parsed ',num_ok,'/', num_intrins)
     supported_insts.add(inst_form)
   else:
     print('Parsed', num_parsed, ' semantics, failling:')
-    print(spec.intrin)
-
-outf.close()
+    print(intrin_name)
 
-pool.terminate()
+close_output()
+cache.close()
 
 print('Parsed:', num_parsed,
     'Skipped:', num_skipped,
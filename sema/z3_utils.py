@@ -1,6 +1,7 @@
 import z3
 import operator
 import functools
+from z3.z3 import _to_expr_ref
 
 z3op_names = {
     z3.Z3_OP_AND: 'and',
@@ -49,20 +50,52 @@ z3op_names = {
     ## z3.Z3_OP_EXTRACT: lambda args, expr: self.mgr.BVExtract(args[0],
     }
 
+def walk_apps(f):
+  '''
+  yield (ast, decl, num_args) for every distinct application in f.
+
+  this talks to the z3 C api directly (on raw Z3_ast pointers, which stay
+  alive as long as f does) so that we don't allocate a python wrapper
+  for every node like `children()` does
+  '''
+  ctx = f.ctx_ref()
+  visited = set()
+  stack = [f.as_ast()]
+  while stack:
+    a = stack.pop()
+    k = z3.Z3_get_ast_id(ctx, a)
+    if k in visited:
+      continue
+    visited.add(k)
+    if z3.Z3_get_ast_kind(ctx, a) != z3.Z3_APP_AST:
+      continue
+    num_args = z3.Z3_get_app_num_args(ctx, a)
+    yield a, z3.Z3_get_app_decl(ctx, a), num_args
+    for i in range(num_args):
+      stack.append(z3.Z3_get_app_arg(ctx, a, i))
+
 def get_vars(f):
-    r = set()
-    def collect(f):
-      if z3.is_const(f):
-          if f.decl().kind() == z3.Z3_OP_UNINTERPRETED and not askey(f) in r:
-              r.add(askey(f))
-      else:
-          for c in f.children():
-              collect(c)
-    collect(f)
-    return r
+    ctx = f.ctx_ref()
+    r = []
+    for a, decl, num_args in walk_apps(f):
+        if num_args == 0 and z3.Z3_get_decl_kind(ctx, decl) == z3.Z3_OP_UNINTERPRETED:
+            r.append(_to_expr_ref(a, f.ctx))
+    return set(r)
 
 def assoc_op(op):
-  return lambda *xs: functools.reduce(op, xs)
+  return lambda *xs: balanced_reduce(op, xs)
+
+def balanced_reduce(op, xs):
+  '''
+  reduce xs with (associative) op into a balanced tree
+  '''
+  xs = list(xs)
+  while len(xs) > 1:
+    reduced = [op(a, b) for a, b in zip(xs[::2], xs[1::2])]
+    if len(xs) % 2 == 1:
+      reduced.append(xs[-1])
+    xs = reduced
+  return xs[0]
 
 class AstRefKey:
     def __init__(self, n):
@@ -78,65 +111,85 @@ def askey(n):
     assert isinstance(n, z3.AstRef)
     return AstRefKey(n)
 
+# mapping (<context>, <ast id>) -> (e, kind of e);
+# ast ids are only unique within a context,
+# and e is kept alive so that z3 doesn't recycle its id (or its context)
+app_kinds = {}
 def get_z3_app(e):
-  decl = z3.Z3_get_app_decl(z3.main_ctx().ref(), e.ast)
-  return z3.Z3_get_decl_kind(z3.main_ctx().ref(), decl)
+  key = id(e.ctx), e.get_id()
+  if key in app_kinds:
+    return app_kinds[key][1]
+  ctx = e.ctx_ref()
+  decl = z3.Z3_get_app_decl(ctx, e.ast)
+  kind = z3.Z3_get_decl_kind(ctx, decl)
+  app_kinds[key] = e, kind
+  return kind
+
+def clear_z3_app_cache():
+  '''
+  forget the memoized results of `get_z3_app` (and release the asts)
+  '''
+  app_kinds.clear()
+
+def is_z3_var(x):
+  return z3.is_const(x) and x.decl().kind() == z3.Z3_OP_UNINTERPRETED
 
 def eval_z3_expr(e, args):
-  return z3.simplify(z3.substitute(e, *args))
+  '''
+  substitute args (a list of (x, value)) into e and simplify
+  '''
+  if not all(is_z3_var(x) for x, _ in args):
+    # models can only bind variables, fall back to rewriting
+    return z3.simplify(z3.substitute(e, *args))
+  # evaluate under a model binding args
+  # instead of substituting and running the full simplifier
+  m = z3.Model(e.ctx)
+  for x, v in args:
+    m.update_value(x, v)
+  return m.eval(e)
 
-s = z3.Solver()
 def equivalent(a, b, test_cases):
   if a.sort() != b.sort():
     return False
 
-  return all(z3.is_true(eval_z3_expr(a==b, test_case))
+  # simplify the shared structure of a==b once
+  # so each test case only has to fold in its own constants
+  eq = z3.simplify(a == b)
+  return all(z3.is_true(eval_z3_expr(eq, test_case))
       for test_case in test_cases)
 
 def serialize_z3_expr(expr):
-  s.push()
-  s.add(expr == 0)
-  dummy_bench = s.to_smt2()
-  s.pop()
-  return dummy_bench
+  # print the dummy benchmark `(assert (= expr 0))` directly,
+  # this is what Solver.to_smt2 does minus the solver round-trip
+  return z3.Z3_benchmark_to_smtlib_string(
+      expr.ctx_ref(), 'benchmark generated from python API', '', 'unknown', '',
+      0, (z3.Ast * 0)(), (expr == 0).as_ast())
 
 def deserialize_z3_expr(serialized):
-  s = z3.Solver()
-  s.from_string(serialized)
-  return s.assertions()[0].children()[0]
+  # parse the assertions directly instead of loading them into a solver
+  [eq] = z3.parse_smt2_string(serialized)
+  return eq.children()[0]
 
 def get_used_bit_range(f, x):
   '''
   get the range of bits of x used in f
   '''
-  bit_range = None
-  def update_bit_range(new_range):
-    nonlocal bit_range
-    if bit_range is None:
-      bit_range = new_range
-    lo = min(bit_range[0], new_range[0])
-    hi = max(bit_range[1], new_range[1])
-    bit_range = lo, hi
+  # `lo` and `hi` of every extract of x
+  los = []
+  his = []
 
-  visited = set()
-  def visit(f):
-    if f in visited:
-      return
-    visited.add(f)
-    if z3.is_app_of(f, z3.Z3_OP_EXTRACT):
-      [base] = f.children()
-      if base.get_id() == x.get_id():
-        hi, lo = f.params()
-        update_bit_range((lo, hi))
-    for arg in f.children():
-      visit(arg)
-  visit(f)
-
-  if bit_range is not None:
-    lo, hi = bit_range
+  ctx = f.ctx_ref()
+  x_id = x.get_id()
+  for a, decl, _ in walk_apps(f):
+    if (z3.Z3_get_decl_kind(ctx, decl) == z3.Z3_OP_EXTRACT and
+        z3.Z3_get_ast_id(ctx, z3.Z3_get_app_arg(ctx, a, 0)) == x_id):
+      his.append(z3.Z3_get_decl_int_parameter(ctx, decl, 0))
+      los.append(z3.Z3_get_decl_int_parameter(ctx, decl, 1))
+
+  if los:
     # the parameters of z3.Extract is inclusive
     # make it exclusive
-    return lo, hi+1
+    return min(los), max(his)+1
 
 uninterpreted_funcs = {}
 def get_uninterpreted_func(func_name, param_types):
@@ -164,6 +217,10 @@ def saturate(x, in_bw, in_signed, out_bw, out_signed):
   lo = get_signed_min(out_bw) if out_signed else get_unsigned_min(out_bw)
   lt = operator.lt if in_signed else z3.ULT
   gt = operator.gt if in_signed else z3.UGT
+  if not in_signed and not out_signed:
+    # x can't be below the unsigned minimum (0),
+    # so only the upper bound needs a select
+    return z3.If(gt(x, hi), hi, x)
   return z3.If(
       gt(x, hi),
       hi,
@@ -172,23 +229,37 @@ def saturate(x, in_bw, in_signed, out_bw, out_signed):
         lo,
         x))
 
+@functools.lru_cache(maxsize=None)
+def get_fix_bitwidth_op(size, bitwidth, signed):
+  '''
+  return a function that resizes a bitvector of `size` bits to `bitwidth`
+  '''
+  if size < bitwidth:
+    ext = z3.SignExt if signed else z3.ZeroExt
+    return functools.partial(ext, bitwidth-size)
+  return functools.partial(z3.Extract, bitwidth-1, 0)
+
 def fix_bitwidth(x, bitwidth, signed=False):
-  if x.size() < bitwidth:
-    if signed:
-      return z3.SignExt(bitwidth-x.size(), x)
-    return z3.ZeroExt(bitwidth-x.size(), x)
-  return z3.Extract(bitwidth-1, 0, x)
+  return get_fix_bitwidth_op(x.size(), bitwidth, signed)(x)
+
+@functools.lru_cache(maxsize=None)
+def get_bv_sort(bitwidth):
+  '''
+  z3.BitVecSort(bitwidth), cached per bitwidth
+  '''
+  return z3.BitVecSort(bitwidth)
 
+@functools.lru_cache(maxsize=None)
 def get_saturator(in_size, out_size, signed):
   in_ty_str = ('s%d' if signed else 'u%d') % in_size
   out_ty_str = ('s%d' if signed else 'u%d') % out_size 
-  in_ty_z3 = z3.BitVecSort(in_size)
-  out_ty_z3 = z3.BitVecSort(out_size)
+  in_ty_z3 = get_bv_sort(in_size)
+  out_ty_z3 = get_bv_sort(out_size)
   builtin_name = 'Saturate_%s_to_%s' % (in_ty_str, out_ty_str)
   return get_uninterpreted_func(builtin_name, [in_ty_z3, out_ty_z3])
 
 def concat(xs):
   if len(xs) == 1:
     return xs[0]
-  return z3.Concat(*xs)
+  return z3.Concat(xs)
 